@@ -10,7 +10,10 @@ import logging
 import os
 import io
 import tempfile
-from datetime import datetime
+import json
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import re
 
 import requests
@@ -23,6 +26,8 @@ import preprocessor as prep
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+calendar_workers = 8  # number of count pages fetched concurrently when updating the availability calendar
+
 
 def start_trektellen_session():
     """
@@ -40,6 +45,25 @@ def start_trektellen_session():
         return session
 
 
+def fetch_count_availability_trektellen(session, date, station_id):
+    """
+    Checks if data is available for a given date and station and reads the counting period from the count page.
+
+    :param session: Trektellen (Requests) session
+    :param date: datetime object
+    :param station_id: Trektellen station id
+    :return: dict with the availability and start and end times of the count
+    """
+    station_url = '{}/{}/{}'.format(os.environ['TREKTELLEN_COUNT_URL'], station_id, date.strftime('%Y%m%d'))
+    r = session.get(station_url)
+
+    if station_url != r.url:
+        return {'available': False, 'start': None, 'end': None}
+
+    start, end = parse_trektellen_count_times(date, r.text)
+    return {'available': True, 'start': start, 'end': end}
+
+
 def check_data_availability_trektellen(session, date, both_stations=True):
     """
     Checks if data is available for a given date.
@@ -49,40 +73,243 @@ def check_data_availability_trektellen(session, date, both_stations=True):
     :param both_stations: Bool indicating whether both stations need to have data available for the given date
     :return: True if data is available for a given date, False if no data is available.
     """
-    date_string = date.strftime('%Y%m%d')
+    station1 = fetch_count_availability_trektellen(session, date, os.environ['TREKTELLEN_STATION1_ID'])
+    station2 = fetch_count_availability_trektellen(session, date, os.environ['TREKTELLEN_STATION2_ID'])
 
-    station1_url = '{}/{}/{}'.format(os.environ['TREKTELLEN_COUNT_URL'],
-                                     os.environ['TREKTELLEN_STATION1_ID'],
-                                     date_string)
-    station2_url = '{}/{}/{}'.format(os.environ['TREKTELLEN_COUNT_URL'],
-                                     os.environ['TREKTELLEN_STATION2_ID'],
-                                     date_string)
+    return summarize_availability(station1, station2, both_stations=both_stations)
 
-    r_station1 = session.get(station1_url)
-    r_station2 = session.get(station2_url)
 
-    r_station1_url = r_station1.url
-    r_station2_url = r_station2.url
+def summarize_availability(station1, station2, both_stations=True):
+    times = {'s1_start': station1['start'], 's1_end': station1['end'],
+             's2_start': station2['start'], 's2_end': station2['end']}
 
-    station1_availability, station2_availability = False, False
-    station1_start, station1_end, station2_start, station2_end = None, None, None, None
+    station_availability = [station1['available'], station2['available']]
 
-    if station1_url == r_station1_url:
-        station1_availability = True
-        station1_start, station1_end = parse_trektellen_count_times(date, r_station1.text)
+    if both_stations:
+        return all(station_availability), station_availability, times
+    else:
+        return any(station_availability), station_availability, times
 
-    if station2_url == r_station2_url:
-        station2_availability = True
-        station2_start, station2_end = parse_trektellen_count_times(date, r_station2.text)
 
-    times = {'s1_start': station1_start, 's1_end': station1_end, 's2_start': station2_start, 's2_end': station2_end}
+def get_availability_calendar_path():
+    path = os.environ.get('AVAILABILITY_CALENDAR_PATH')
+    if not path:
+        path = os.path.join(tempfile.gettempdir(), 'brc_availability_calendar.json')
+    return path
 
-    station_availability = [station1_availability, station2_availability]
 
-    if both_stations:
-        return all(station_availability), station_availability, times
+def parse_calendar_time(time_string):
+    if time_string is None:
+        return None
+    return datetime.strptime(time_string, '%Y-%m-%dT%H:%M:%S')
+
+
+def format_calendar_time(time):
+    if time is None:
+        return None
+    return time.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def load_availability_calendar(path=None):
+    """
+    Loads the locally stored availability calendar, holding the availability and counting periods of both stations
+    per date. Returns an empty calendar if none is stored yet or if the stored calendar cannot be read.
+
+    :param path: path of the calendar file
+    :return: dict with dates (YYYYMMDD) as keys
+    """
+    if path is None:
+        path = get_availability_calendar_path()
+
+    if not os.path.exists(path):
+        return {}
+
+    # An unreadable calendar is only a cache, so start over with an empty calendar instead
+    try:
+        with open(path, 'r') as f:
+            stored = json.load(f)
+
+        calendar = {}
+        for date_string, entry in stored.items():
+            calendar[date_string] = {'checked': parse_calendar_time(entry['checked'])}
+            for station in ['s1', 's2']:
+                calendar[date_string][station] = {
+                    'available': entry[station]['available'],
+                    'start': parse_calendar_time(entry[station]['start']),
+                    'end': parse_calendar_time(entry[station]['end'])
+                }
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.warning('Cannot read availability calendar {}: {}'.format(path, e))
+        return {}
+
+    return calendar
+
+
+def save_availability_calendar(calendar, path=None):
+    if path is None:
+        path = get_availability_calendar_path()
+
+    stored = {}
+    for date_string, entry in calendar.items():
+        stored[date_string] = {'checked': format_calendar_time(entry['checked'])}
+        for station in ['s1', 's2']:
+            stored[date_string][station] = {
+                'available': entry[station]['available'],
+                'start': format_calendar_time(entry[station]['start']),
+                'end': format_calendar_time(entry[station]['end'])
+            }
+
+    # Write to a unique temporary file first, so interrupted or concurrent writes never leave a corrupt calendar behind
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(stored, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def availability_in_flux(calendar, date):
+    """
+    Checks whether the availability or counting period of a date may still change, which is the case if the date is
+    missing from the calendar, if not both stations had data available yet or if the date was last checked before the
+    day was over.
+
+    :param calendar: availability calendar
+    :param date: datetime object
+    :return: True if the date needs to be refreshed, False otherwise
+    """
+    entry = calendar.get(date.strftime('%Y%m%d'))
+
+    if entry is None:
+        return True
+
+    if not (entry['s1']['available'] and entry['s2']['available']):
+        return True
+
+    return entry['checked'].date() <= date.date()
+
+
+def update_availability_calendar(session, calendar, dates, max_workers=calendar_workers, skip_failed=True):
+    """
+    Refreshes the availability calendar for all given dates that are still in flux, fetching the count pages
+    concurrently if more than one date is in flux.
+
+    :param session: Trektellen (Requests) session
+    :param calendar: availability calendar
+    :param dates: iterable of datetime objects
+    :param max_workers: maximum number of concurrent page fetches
+    :param skip_failed: Bool indicating whether dates that cannot be fetched are logged and skipped instead of raising
+    :return: the updated availability calendar
+    """
+    dates = [date for date in dates if availability_in_flux(calendar, date)]
+
+    if not dates:
+        return calendar
+
+    stations = [('s1', os.environ['TREKTELLEN_STATION1_ID']), ('s2', os.environ['TREKTELLEN_STATION2_ID'])]
+    requests_to_fetch = [(date, station, station_id) for date in dates for station, station_id in stations]
+
+    checked = datetime.now().replace(microsecond=0)
+
+    results = []
+
+    if len(dates) == 1:
+        # The two pages of a single date are fetched with the given session, reusing its connection for the download
+        for date, _, station_id in requests_to_fetch:
+            try:
+                results.append((fetch_count_availability_trektellen(session, date, station_id), None))
+            except Exception as e:
+                results.append((None, e))
     else:
-        return any(station_availability), station_availability, times
+        # Requests does not guarantee that sessions are thread-safe, so every thread gets its own session with the
+        # login cookies of the given session
+        thread_sessions = threading.local()
+
+        def fetch(date, station_id):
+            if not hasattr(thread_sessions, 'session'):
+                thread_sessions.session = requests.Session()
+                thread_sessions.session.cookies.update(session.cookies)
+            return fetch_count_availability_trektellen(thread_sessions.session, date, station_id)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fetch, date, station_id) for date, _, station_id in requests_to_fetch]
+
+        for future in futures:
+            error = future.exception()
+            results.append((None, error) if error is not None else (future.result(), None))
+
+    fetched = {}
+    failed = set()
+
+    for (date, station, _), (result, error) in zip(requests_to_fetch, results):
+        date_string = date.strftime('%Y%m%d')
+
+        if error is not None:
+            if not skip_failed:
+                raise error
+            logger.error('Cannot check availability of station {} on {}: {}'.format(station, date_string, error))
+            failed.add(date_string)
+            continue
+
+        fetched.setdefault(date_string, {})[station] = result
+
+    # Dates with a failed fetch are left as they were, so they remain in flux and are fetched again next time
+    for date_string, stations_fetched in fetched.items():
+        if date_string in failed:
+            continue
+        calendar[date_string] = dict(stations_fetched, checked=checked)
+
+    return calendar
+
+
+def fill_availability_calendar(session, calendar, max_workers=calendar_workers):
+    """
+    Fills the availability calendar for all dates of the current season up to today.
+
+    :param session: Trektellen (Requests) session
+    :param calendar: availability calendar
+    :param max_workers: maximum number of concurrent page fetches
+    :return: the updated availability calendar
+    """
+    season_start = datetime.strptime(os.environ['CURRENT_SEASON_START'], '%Y-%m-%d')
+    season_end = datetime.strptime(os.environ['CURRENT_SEASON_END'], '%Y-%m-%d')
+    last_date = min(season_end, datetime.now())
+
+    dates = [season_start + timedelta(days=day) for day in range((last_date - season_start).days + 1)]
+    return update_availability_calendar(session, calendar, dates, max_workers=max_workers)
+
+
+def fill_saved_availability_calendar():
+    """
+    Logs in to Trektellen, fills the stored availability calendar for the whole season and saves it.
+
+    :return: the updated availability calendar
+    """
+    s = start_trektellen_session()
+    calendar = load_availability_calendar()
+    fill_availability_calendar(s, calendar)
+    save_availability_calendar(calendar)
+    return calendar
+
+
+def check_data_availability_calendar(calendar, date, both_stations=True):
+    """
+    Checks if data is available for a given date according to the availability calendar. Dates missing from the
+    calendar are considered unavailable.
+
+    :param calendar: availability calendar
+    :param date: datetime object
+    :param both_stations: Bool indicating whether both stations need to have data available for the given date
+    :return: True if data is available for a given date, False if no data is available.
+    """
+    unavailable = {'available': False, 'start': None, 'end': None}
+    entry = calendar.get(date.strftime('%Y%m%d'), {})
+
+    return summarize_availability(entry.get('s1', unavailable), entry.get('s2', unavailable),
+                                  both_stations=both_stations)
 
 
 def parse_trektellen_count_times(date, html):
@@ -185,6 +412,12 @@ def create_html_response(message):
 
 
 def main(event, context):
+    if event.get('queryStringParameters') and event['queryStringParameters'].get('calendar') == 'fill':
+        calendar = fill_saved_availability_calendar()
+        message = 'Availability calendar is filled for {} dates.'.format(len(calendar))
+        response = create_html_response(message)
+        return response
+
     dbx = start_dropbox_session()
 
     if 'queryStringParameters' in event:
@@ -216,7 +449,14 @@ def main(event, context):
         return response
 
     s = start_trektellen_session()
-    both_stations_uploaded, _, times = check_data_availability_trektellen(s, date, both_stations=True)
+
+    # Only fetch the count pages if the availability of this date may have changed since it was last checked
+    calendar = load_availability_calendar()
+    # A failed fetch raises, as processing without count times would upload files without START and END records
+    update_availability_calendar(s, calendar, [date], skip_failed=False)
+    save_availability_calendar(calendar)
+
+    both_stations_uploaded, _, times = check_data_availability_calendar(calendar, date, both_stations=True)
 
     if not both_stations_uploaded and not forced:
         message = 'Data for {} for both stations is not uploaded to Trektellen yet.'.format(date.strftime('%d-%m-%Y'))
@@ -264,4 +504,5 @@ def main(event, context):
 if __name__ == "__main__":
     # main({'date': '20180827', 'forced': 'yes'}, None)
     # main({'date': '20190917', 'forced': 'no'}, None)
+    # main({'queryStringParameters': {'calendar': 'fill'}}, None)
     main({'queryStringParameters': {'date': '20181006', 'forced': 'yes'}}, None)
@@ -0,0 +1,419 @@
+"""
+The load test runs the fetcher handler end-to-end against a local stand-in for Trektellen and an in-memory stand-in for
+Dropbox. It reports handler latency, bytes transferred and a breakdown of time spent per stage, for cold and warm
+invocations.
+
+Author: Bart Hoekstra
+Email: bart.hoekstra@batumiraptorcount.org
+"""
+
+import argparse
+import csv
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import dropbox.exceptions
+
+species = ['HB', 'HB_JUV', 'HB_NONJUV', 'BK', 'BK_JUV', 'BK_NONJUV', 'Marsh', 'Mon', 'Pal', 'BootedE', 'StepBuz']
+locations = ['W3', 'W2', 'W1', 'O', 'E1', 'E2', 'E3']
+csv_columns = ['countid', 'speciesid', 'year', 'yday', 'date', 'timestamp', 'telpost', 'speciesname', 'count',
+               'countback', 'local', 'age', 'sex', 'plumage', 'remark', 'location', 'migtype', 'counttype']
+
+# Environment used by the fetcher and preprocessor during the load test. Trektellen URLs are completed with the address
+# of the fake Trektellen server once it is running.
+load_test_environment = {
+    'TREKTELLEN_USERNAME': 'loadtest',
+    'TREKTELLEN_PASSWORD': 'loadtest',
+    'TREKTELLEN_STATION1_ID': '1047',
+    'TREKTELLEN_STATION2_ID': '1048',
+    'DROPBOX_ACCESS_TOKEN': 'loadtest',
+    'DROPBOX_ROOT_DATA_FOLDER': '/brc',
+    'CURRENT_SEASON_START': '2019-08-12',
+    'CURRENT_SEASON_END': '2019-10-21',
+    'HB_FOCUS_START': '2019-08-21',
+    'HB_FOCUS_END': '2019-09-09',
+    'TIME_WINDOW_MINUTES': '5',
+}
+
+
+def create_season_csv(season, rows_per_day, seed=0):
+    """
+    Creates synthetic Trektellen CSV data for both stations for every day of the season.
+
+    :param season: year of the season
+    :param rows_per_day: number of records per day
+    :param seed: random seed
+    :return: CSV data as bytes
+    """
+    rng = random.Random(seed)
+    season_start = datetime.strptime(load_test_environment['CURRENT_SEASON_START'], '%Y-%m-%d').replace(year=season)
+    season_end = datetime.strptime(load_test_environment['CURRENT_SEASON_END'], '%Y-%m-%d').replace(year=season)
+
+    f = io.StringIO()
+    writer = csv.writer(f)
+    writer.writerow(csv_columns)
+
+    countid = 0
+    date = season_start
+    while date <= season_end:
+        seconds = sorted(rng.randint(6 * 3600, 18 * 3600) for _ in range(rows_per_day))
+        for second in seconds:
+            countid += 1
+            timestamp = (datetime.min + timedelta(seconds=second)).strftime('%H:%M:%S')
+            writer.writerow([countid, 1, season, date.timetuple().tm_yday, date.strftime('%Y-%m-%d'), timestamp,
+                             rng.choice([1047, 1048]), rng.choice(species), rng.choice([1, 1, 2, 5]), 0, 0, '', '', '',
+                             '', rng.choice(locations), '', rng.choice(['', '', 'S', 'D'])])
+        date += timedelta(days=1)
+
+    return f.getvalue().encode('utf-8')
+
+
+class FakeTrektellenHandler(BaseHTTPRequestHandler):
+    """
+    Serves the Trektellen login, count pages and season CSV downloads used by the fetcher.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type='text/html'):
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_redirect(self, location):
+        time.sleep(self.server.latency)
+        self.send_response(303)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+
+        if self.path == '/auth/login':
+            self.send_redirect('/user/sites')
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+
+        if self.path == '/user/sites':
+            self.send_body(b'<html><body>Sites</body></html>')
+        elif parts[:2] == ['count', 'view'] and len(parts) == 4:
+            if parts[3] in self.server.unavailable_dates:
+                self.send_redirect('/user/sites')
+                return
+            padding = 'x' * self.server.page_size
+            body = '<html><body><p>Counting period: 06:30 - 17:45</p><p>{}</p></body></html>'.format(padding)
+            self.send_body(body.encode('utf-8'))
+        elif parts[:2] == ['download', 'brc_csv'] and len(parts) == 3:
+            self.send_body(self.server.season_csv(int(parts[2])), content_type='text/csv')
+        else:
+            self.send_error(404)
+
+
+class FakeTrektellenServer(ThreadingHTTPServer):
+    """
+    Local stand-in for Trektellen with a configurable latency per request, count page size and number of records per
+    day in the season CSV.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, page_size=50000, rows_per_day=500, unavailable_dates=()):
+        super().__init__(('127.0.0.1', 0), FakeTrektellenHandler)
+        self.latency = latency
+        self.page_size = page_size
+        self.rows_per_day = rows_per_day
+        self.unavailable_dates = set(unavailable_dates)
+        self.lock = threading.Lock()
+        self.season_csvs = {}
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def season_csv(self, season):
+        with self.lock:
+            if season not in self.season_csvs:
+                self.season_csvs[season] = create_season_csv(season, self.rows_per_day, seed=season)
+            return self.season_csvs[season]
+
+    def environment(self):
+        return {
+            'TREKTELLEN_LOGIN_URL': '{}/auth/login'.format(self.url),
+            'TREKTELLEN_SUCCESSFUL_LOGIN_URL': '{}/user/sites'.format(self.url),
+            'TREKTELLEN_DOWNLOAD_URL': '{}/download/brc_csv/'.format(self.url),
+            'TREKTELLEN_COUNT_URL': '{}/count/view'.format(self.url),
+        }
+
+
+class FakeDropbox:
+    """
+    Stand-in for the Dropbox client, implementing the calls made by the fetcher. Files are stored in a local directory,
+    so that all worker processes share them like Lambda containers share the real Dropbox.
+    """
+    def __init__(self, directory, latency=0.0):
+        self.directory = directory
+        self.latency = latency
+        self.bytes_uploaded = 0
+
+    def local_path(self, path):
+        return os.path.join(self.directory, path.lstrip('/'))
+
+    def users_get_current_account(self):
+        time.sleep(self.latency)
+        return {}
+
+    def files_get_metadata(self, path):
+        time.sleep(self.latency)
+        if path == os.environ['DROPBOX_ROOT_DATA_FOLDER'] or os.path.exists(self.local_path(path)):
+            return {'path_display': path}
+        raise dropbox.exceptions.ApiError(None, 'not_found', None, None)
+
+    def files_upload(self, f, path, mode=None):
+        time.sleep(self.latency)
+        local_path = self.local_path(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, 'wb') as local_file:
+            local_file.write(f)
+        self.bytes_uploaded += len(f)
+        return {'path_display': path}
+
+
+# State of a load test worker process, which plays the role of a single Lambda container
+worker = {}
+
+
+def init_worker(environment, dropbox_directory, dropbox_latency, fill_calendar):
+    os.environ.update(environment)
+    os.environ['AVAILABILITY_CALENDAR_PATH'] = os.path.join(tempfile.mkdtemp(), 'availability_calendar.json')
+
+    # Importing the handler is part of a cold start
+    start = time.perf_counter()
+    import fetcher
+    worker['import_time'] = time.perf_counter() - start
+
+    worker['fetcher'] = fetcher
+    worker['warm'] = False
+    worker['stages'] = {}
+    worker['bytes_downloaded'] = 0
+    worker['lock'] = threading.Lock()
+
+    # Files uploaded by earlier invocations of any worker stay in the shared Dropbox directory
+    worker['dropbox'] = FakeDropbox(dropbox_directory, latency=dropbox_latency)
+
+    def start_dropbox_session():
+        return worker['dropbox']
+
+    fetcher.start_dropbox_session = start_dropbox_session
+
+    if fill_calendar:
+        fetcher.fill_saved_availability_calendar()
+
+    for name in ['start_dropbox_session', 'check_data_exists_dropbox', 'start_trektellen_session',
+                 'load_availability_calendar', 'update_availability_calendar', 'save_availability_calendar',
+                 'download_trektellen_data', 'upload_file']:
+        setattr(fetcher, name, timed_stage(name, getattr(fetcher, name)))
+
+    for name in ['preprocess_raw_trektellen_data', 'preprocess_trektellen_data']:
+        setattr(fetcher.prep, name, timed_stage(name, getattr(fetcher.prep, name)))
+
+    fetcher.prep.pd.DataFrame.to_excel = timed_stage('to_excel', fetcher.prep.pd.DataFrame.to_excel)
+
+    request = requests.Session.request
+
+    def counting_request(self, method, url, **kwargs):
+        r = request(self, method, url, **kwargs)
+        # The availability calendar fetches count pages from several threads at once
+        with worker['lock']:
+            worker['bytes_downloaded'] += len(r.content)
+        return r
+
+    requests.Session.request = counting_request
+
+
+def timed_stage(name, function):
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            worker['stages'][name] = worker['stages'].get(name, 0.0) + time.perf_counter() - start
+    return timed
+
+
+def invoke_handler(date, forced):
+    """
+    Invokes the fetcher handler once for a given date in a worker process.
+
+    :param date: date string (YYYYMMDD)
+    :param forced: 'yes' to process dates that are not uploaded for both stations, 'no' otherwise
+    :return: dict with latency, bytes transferred, outcome and time spent per stage
+    """
+    worker['stages'] = {}
+    worker['bytes_downloaded'] = 0
+    worker['dropbox'].bytes_uploaded = 0
+    cold = not worker['warm']
+
+    start = time.perf_counter()
+    response = worker['fetcher'].main({'queryStringParameters': {'date': date, 'forced': forced}}, None)
+    latency = time.perf_counter() - start
+
+    worker['warm'] = True
+
+    stages = dict(worker['stages'])
+    stages['other'] = max(latency - sum(stages.values()), 0.0)
+
+    if cold:
+        stages['import'] = worker['import_time']
+        latency += worker['import_time']
+
+    if 'processed already' in response['body']:
+        outcome = 'already processed'
+    elif 'not uploaded' in response['body']:
+        outcome = 'not uploaded'
+    else:
+        outcome = 'processed'
+
+    return {
+        'date': date,
+        'cold': cold,
+        'status': response['statusCode'],
+        'outcome': outcome,
+        'latency': latency,
+        'bytes_downloaded': worker['bytes_downloaded'],
+        'bytes_uploaded': worker['dropbox'].bytes_uploaded,
+        'stages': stages
+    }
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    index = min(int(round(q / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def run_load_test(server, invocations, concurrency, dropbox_latency=0.0, nr_dates=None, forced='yes',
+                  fill_calendar=False):
+    """
+    Fires handler invocations for consecutive dates of the season from a pool of worker processes, cycling through the
+    first nr_dates dates. Concurrency 1 runs the invocations sequentially.
+
+    :param server: running FakeTrektellenServer
+    :param invocations: number of handler invocations
+    :param concurrency: number of worker processes invoking the handler at the same time
+    :param dropbox_latency: latency in seconds of every fake Dropbox call
+    :param nr_dates: number of distinct dates to invoke the handler for, all dates of the season if None
+    :param forced: 'yes' to process dates that are not uploaded for both stations, 'no' otherwise
+    :param fill_calendar: Bool indicating whether workers fill the availability calendar before the first invocation
+    :return: list of invocation results and the wall clock duration in seconds
+    """
+    environment = dict(load_test_environment)
+    environment.update(server.environment())
+
+    season_start = datetime.strptime(environment['CURRENT_SEASON_START'], '%Y-%m-%d')
+    season_end = datetime.strptime(environment['CURRENT_SEASON_END'], '%Y-%m-%d')
+    season_days = (season_end - season_start).days + 1
+    if nr_dates is not None:
+        season_days = min(nr_dates, season_days)
+    dates = [(season_start + timedelta(days=i % season_days)).strftime('%Y%m%d') for i in range(invocations)]
+
+    with tempfile.TemporaryDirectory() as dropbox_directory:
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=concurrency, initializer=init_worker,
+                                 initargs=(environment, dropbox_directory, dropbox_latency, fill_calendar)) as executor:
+            results = list(executor.map(invoke_handler, dates, [forced] * len(dates)))
+        duration = time.perf_counter() - start
+
+    return results, duration
+
+
+def report(title, results, duration):
+    lines = ['{} - {} invocations in {:.2f} s ({:.2f} invocations/s)'.format(title, len(results), duration,
+                                                                           len(results) / duration)]
+
+    for label, selection in [('all', results),
+                             ('cold', [result for result in results if result['cold']]),
+                             ('warm', [result for result in results if not result['cold']])]:
+        if not selection:
+            continue
+        latencies = [result['latency'] for result in selection]
+        lines.append('  {:<5} n={:<4} p50={:.3f} s  p95={:.3f} s'.format(label, len(selection),
+                                                                        percentile(latencies, 50),
+                                                                        percentile(latencies, 95)))
+
+    outcomes = sorted({result['outcome'] for result in results})
+    lines.append('  outcomes: {}'.format(', '.join('{} {}'.format(len([result for result in results
+                                                                      if result['outcome'] == outcome]), outcome)
+                                                   for outcome in outcomes)))
+
+    downloaded = sum(result['bytes_downloaded'] for result in results)
+    uploaded = sum(result['bytes_uploaded'] for result in results)
+    lines.append('  bytes downloaded: {} ({:.0f} per invocation)'.format(downloaded, downloaded / len(results)))
+    lines.append('  bytes uploaded:   {} ({:.0f} per invocation)'.format(uploaded, uploaded / len(results)))
+
+    # Percentiles of a stage only cover the invocations that reached it, e.g. imports only happen on cold starts
+    lines.append('  stages:')
+    stages = sorted({stage for result in results for stage in result['stages']})
+    for stage in stages:
+        times = [result['stages'][stage] for result in results if stage in result['stages']]
+        lines.append('    {:<32} n={:<4} p50={:.3f} s  p95={:.3f} s'.format(stage, len(times), percentile(times, 50),
+                                                                         percentile(times, 95)))
+
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the fetcher handler against local stand-ins.')
+    parser.add_argument('--invocations', type=int, default=20, help='number of handler invocations per run')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of concurrent invocations')
+    parser.add_argument('--latency', type=float, default=0.05, help='Trektellen latency per request in seconds')
+    parser.add_argument('--dropbox-latency', type=float, default=0.05, help='Dropbox latency per call in seconds')
+    parser.add_argument('--page-size', type=int, default=50000, help='padding of count pages in bytes')
+    parser.add_argument('--rows-per-day', type=int, default=500, help='records per day in the season CSV')
+    parser.add_argument('--dates', type=int, default=None,
+                        help='number of distinct dates to cycle through, repeating dates once exceeded')
+    parser.add_argument('--forced', choices=['yes', 'no'], default='yes',
+                        help='process dates that are not uploaded for both stations')
+    parser.add_argument('--unavailable-dates', nargs='*', default=[], metavar='YYYYMMDD',
+                        help='dates for which the count pages are not available')
+    parser.add_argument('--fill-calendar', action='store_true',
+                        help='fill the availability calendar in every worker before its first invocation')
+    args = parser.parse_args()
+
+    server = FakeTrektellenServer(latency=args.latency, page_size=args.page_size, rows_per_day=args.rows_per_day,
+                                  unavailable_dates=args.unavailable_dates)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        options = {'dropbox_latency': args.dropbox_latency, 'nr_dates': args.dates, 'forced': args.forced,
+                   'fill_calendar': args.fill_calendar}
+
+        results, duration = run_load_test(server, args.invocations, 1, **options)
+        print(report('Sequential', results, duration))
+
+        results, duration = run_load_test(server, args.invocations, args.concurrency, **options)
+        print(report('Concurrent ({} workers)'.format(args.concurrency), results, duration))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,8 @@ season_end = os.environ['CURRENT_SEASON_END']
 hb_focus_start = os.environ['HB_FOCUS_START']
 hb_focus_end = os.environ['HB_FOCUS_END']
 window_minutes = int(os.environ['TIME_WINDOW_MINUTES'])  # window used to check total number of birds with aged numbers
+doublecount_minutes = 10  # window within which both records of a doublecount are expected
+chunk_rows = 50000  # number of rows read at once during out-of-core processing
 
 # Overlapping zones. For both stations the distance codes are keys and the corresponding overlapping distance codes from
 # the other station are values
@@ -99,28 +101,50 @@ expected_combinations = {
 }
 
 
-def preprocess_raw_trektellen_data(data_csv, times=None, date=None, split_by_station=False):
-    data = pd.read_csv(data_csv)
-
+def combine_date_and_timestamp(data):
     # Change timestamp to 00:00 if timestamp was missing
     timestamp_missing = data['timestamp'].isnull()
     data.loc[timestamp_missing, 'timestamp'] = '00:00:00.00'
 
     # Create a new datetime column combining both the original date and timestamp columns
     data['datetime'] = pd.to_datetime(data.date, format='%Y-%m-%d') + pd.to_timedelta(data.timestamp)
+    return data
+
+
+def select_season(data, date=None, all_seasons=False):
+    # Select all records from counts within the predetermined season or date, or all records for all seasons
+    if all_seasons:
+        season = pd.Series(True, index=data.index)
+    elif date is None:
+        season = (data['datetime'] > season_start) & (data['datetime'] <= season_end)
+    else:
+        date_string = date.strftime('%Y-%m-%d')
+        date_next = date + datetime.timedelta(days=1)
+        date_next_string = date_next.strftime('%Y-%m-%d')
+        season = (data['datetime'] >= date_string) & (data['datetime'] < date_next_string)
+
+    return season
+
+
+def create_count_time_records(times):
+    time_records = [[times['s1_start'], 1047, 'START', 1, 0, 0, 'O'],
+                    [times['s1_end'], 1047, 'END', 1, 0, 0, 'O'],
+                    [times['s2_start'], 1048, 'START', 1, 0, 0, 'O'],
+                    [times['s2_end'], 1048, 'END', 1, 0, 0, 'O']]
+
+    count_times = pd.DataFrame(time_records, columns=['datetime', 'telpost', 'speciesname', 'count',
+                                                      'countback', 'local', 'location'])
+    return count_times
+
+
+def format_raw_trektellen_data(data, count_times=None, date=None, all_seasons=False):
+    data = combine_date_and_timestamp(data)
 
     # Remove unused columns, including the date and timestamp columns, which we can regenerate later on
     data.drop(columns=['date', 'timestamp', 'countid', 'speciesid', 'year', 'yday'], inplace=True)
 
     # Add start and end times
-    if times:
-        time_records = [[times['s1_start'], 1047, 'START', 1, 0, 0, 'O'],
-                        [times['s1_end'], 1047, 'END', 1, 0, 0, 'O'],
-                        [times['s2_start'], 1048, 'START', 1, 0, 0, 'O'],
-                        [times['s2_end'], 1048, 'END', 1, 0, 0, 'O']]
-
-        count_times = pd.DataFrame(time_records, columns=['datetime', 'telpost', 'speciesname', 'count',
-                                                          'countback', 'local', 'location'])
+    if count_times is not None:
         data = pd.concat([data, count_times], sort=True)
 
     # Change column order
@@ -146,15 +170,18 @@ def preprocess_raw_trektellen_data(data_csv, times=None, date=None, split_by_sta
     data.sort_values(by=['datetime', 'telpost'], inplace=True)
 
     # Remove all records from counts outside of the predetermined season or date
-    if date is None:
-        season = (data['datetime'] > season_start) & (data['datetime'] <= season_end)
-    else:
-        date_string = date.strftime('%Y-%m-%d')
-        date_next = date + datetime.timedelta(days=1)
-        date_next_string = date_next.strftime('%Y-%m-%d')
-        season = (data['datetime'] >= date_string) & (data['datetime'] < date_next_string)
+    data = data[select_season(data, date, all_seasons=all_seasons)]
+    return data
 
-    data = data[season]
+
+def preprocess_raw_trektellen_data(data_csv, times=None, date=None, split_by_station=False, all_seasons=False):
+    data = pd.read_csv(data_csv)
+
+    count_times = None
+    if times:
+        count_times = create_count_time_records(times)
+
+    data = format_raw_trektellen_data(data, count_times, date=date, all_seasons=all_seasons)
 
     # Now reset the index to start off fresh
     data.reset_index(drop=True, inplace=True)
@@ -169,62 +196,69 @@ def preprocess_raw_trektellen_data(data_csv, times=None, date=None, split_by_sta
         return data
 
 
-def preprocess_trektellen_data(data, split_by_station=False):
-    # Check doublecounts
-    doublecount_records = data[data['counttype'] == 'D']
-    doublecount_records.reset_index(inplace=True)
-    nr_doublecounts = doublecount_records.shape[0]
+def doublecount_suspicious(row, next_row):
+    suspicious = False
 
-    suspicious_dc_records = []
+    # Compare times. Do the double counts fall within a 10 minute window from each other?
+    minutes_diff = (next_row['datetime'] - row['datetime']).total_seconds() / 60.0
 
-    iter_doublecounts = doublecount_records.iterrows()
+    if minutes_diff > doublecount_minutes:
+        suspicious = True
 
-    for index, row in iter_doublecounts:
-        suspicious = False
+    # Are the species the same?
+    if row['speciesname'] != next_row['speciesname']:
+        suspicious = True
 
-        if index == nr_doublecounts - 1:
-            break
+    # Age the same?
+    if not pd.isna(row['age']) and pd.isna(next_row['age']):
+        if row['age'] != next_row['age']:
+            suspicious = True
 
-        next_row = doublecount_records.iloc[index + 1]  # index is 0-based
+    # Sex the same?
+    if not pd.isna(row['sex']) and pd.isna(next_row['sex']):
+        if row['sex'] != next_row['sex']:
+            suspicious = True
 
-        # Compare times. Do the double counts fall within a 10 minute window from each other?
-        minutes_diff = (next_row['datetime'] - row['datetime']).total_seconds() / 60.0
+    # Count the same?
+    if row['count'] != next_row['count'] or row['countback'] != next_row['countback']:
+        suspicious = True
 
-        if minutes_diff > 10:
-            suspicious = True
+    # Compare distance codes
+    # Consecutive doublecount records cannot be from the same station
+    if row['telpost'] == next_row['telpost']:
+        suspicious = True
 
-        # Are the species the same?
-        if row['speciesname'] != next_row['speciesname']:
-            suspicious = True
+    # Distance codes are not overlapping
+    if not next_row['location'] in overlapping_zones[row['telpost']][row['location']]:
+        suspicious = True
 
-        # Age the same?
-        if not pd.isna(row['age']) and pd.isna(next_row['age']):
-            if row['age'] != next_row['age']:
-                suspicious = True
+    return suspicious
 
-        # Sex the same?
-        if not pd.isna(row['sex']) and pd.isna(next_row['sex']):
-            if row['sex'] != next_row['sex']:
-                suspicious = True
 
-        # Count the same?
-        if row['count'] != next_row['count'] or row['countback'] != next_row['countback']:
-            suspicious = True
+def check_doublecounts(data):
+    doublecount_records = data[data['counttype'] == 'D']
+    doublecount_records.reset_index(inplace=True)
+    nr_doublecounts = doublecount_records.shape[0]
 
-        # Compare distance codes
-        # Consecutive doublecount records cannot be from the same station
-        if row['telpost'] == next_row['telpost']:
-            suspicious = True
+    suspicious_dc_records = []
 
-        # Distance codes are not overlapping
-        if not next_row['location'] in overlapping_zones[row['telpost']][row['location']]:
-            suspicious = True
+    iter_doublecounts = doublecount_records.iterrows()
 
-        if not suspicious:
+    for index, row in iter_doublecounts:
+        if index == nr_doublecounts - 1:
+            break
+
+        next_row = doublecount_records.iloc[index + 1]  # index is 0-based
+
+        if not doublecount_suspicious(row, next_row):
             next(iter_doublecounts)
         else:
             suspicious_dc_records.extend([row['index']])
 
+    return suspicious_dc_records
+
+
+def check_records(data, suspicious_dc_records):
     # Check if records contain protocol species or protocol codes
     codes = ['START', 'END', 'SHOT']
     nonprotocol_species = ~data['speciesname'].isin(expected_combinations.keys()) & ~data['speciesname'].isin(codes)
@@ -407,24 +441,32 @@ def preprocess_trektellen_data(data, split_by_station=False):
     unreliable_female_pallid_records = data[unreliable_female_pallid].index.values.tolist()
 
     # Add flags to check column
-    data['check'] = ""
-    data.loc[unexpected_age_records, 'check'] = data.loc[unexpected_age_records, 'check'] + 'unexpected age, '
-    data.loc[unexpected_sex_records, 'check'] = data.loc[unexpected_sex_records, 'check'] + 'unexpected sex, '
-    data.loc[unexpected_harrier_records, 'check'] = data.loc[unexpected_harrier_records, 'check'] + 'unexpected species+age+sex combination, '
-    data.loc[ageing_outside_permitted_distances_records, 'check'] = data.loc[ageing_outside_permitted_distances_records, 'check'] + 'ageing distance, '
-    data.loc[non_singlecount_hb_records, 'check'] = data.loc[non_singlecount_hb_records, 'check'] + 'singlecount missing? (leave as is), '
-    data.loc[count_age_mismatch_records_hb, 'check'] = data.loc[count_age_mismatch_records_hb, 'check'] + 'mismatch number of counted and aged birds, '
-    data.loc[count_age_mismatch_records_bk, 'check'] = data.loc[count_age_mismatch_records_bk, 'check'] + 'mismatch number of counted and aged birds, '
-    data.loc[suspicious_morphs, 'check'] = data.loc[suspicious_morphs, 'check'] + 'unexpected morph, '
-    data.loc[missing_timestamps, 'check'] = data.loc[missing_timestamps, 'check'] + 'incorrect timestamp, '
-    data.loc[suspicious_location_records, 'check'] = data.loc[suspicious_location_records, 'check'] + 'unusual location, '
-    data.loc[gap_records, 'check'] = data.loc[gap_records, 'check'] + 'gaps in essential columns, '
-    data.loc[suspicious_dc_records, 'check'] = data.loc[suspicious_dc_records, 'check'] + 'erroneous doublecount (leave as is), '
-    data.loc[suspicious_migtype_records, 'check'] = data.loc[suspicious_migtype_records, 'check'] + 'unusual nr of killed/injured birds, '
-    data.loc[unreliable_ageing_records, 'check'] = data.loc[unreliable_ageing_records, 'check'] + 'doubtful ageing, '
-    data.loc[unreliable_female_pallid_records, 'check'] = data.loc[unreliable_female_pallid_records, 'check'] + 'doubtful ageing, '
-    data.loc[nonprotocol_species_records, 'check'] = 'non-protocol species, '
-    data['check'] = data['check'].str[:-2]
+    check = pd.Series("", index=data.index)
+    check.loc[unexpected_age_records] = check.loc[unexpected_age_records] + 'unexpected age, '
+    check.loc[unexpected_sex_records] = check.loc[unexpected_sex_records] + 'unexpected sex, '
+    check.loc[unexpected_harrier_records] = check.loc[unexpected_harrier_records] + 'unexpected species+age+sex combination, '
+    check.loc[ageing_outside_permitted_distances_records] = check.loc[ageing_outside_permitted_distances_records] + 'ageing distance, '
+    check.loc[non_singlecount_hb_records] = check.loc[non_singlecount_hb_records] + 'singlecount missing? (leave as is), '
+    check.loc[count_age_mismatch_records_hb] = check.loc[count_age_mismatch_records_hb] + 'mismatch number of counted and aged birds, '
+    check.loc[count_age_mismatch_records_bk] = check.loc[count_age_mismatch_records_bk] + 'mismatch number of counted and aged birds, '
+    check.loc[suspicious_morphs] = check.loc[suspicious_morphs] + 'unexpected morph, '
+    check.loc[missing_timestamps] = check.loc[missing_timestamps] + 'incorrect timestamp, '
+    check.loc[suspicious_location_records] = check.loc[suspicious_location_records] + 'unusual location, '
+    check.loc[gap_records] = check.loc[gap_records] + 'gaps in essential columns, '
+    check.loc[suspicious_dc_records] = check.loc[suspicious_dc_records] + 'erroneous doublecount (leave as is), '
+    check.loc[suspicious_migtype_records] = check.loc[suspicious_migtype_records] + 'unusual nr of killed/injured birds, '
+    check.loc[unreliable_ageing_records] = check.loc[unreliable_ageing_records] + 'doubtful ageing, '
+    check.loc[unreliable_female_pallid_records] = check.loc[unreliable_female_pallid_records] + 'doubtful ageing, '
+    check.loc[nonprotocol_species_records] = 'non-protocol species, '
+    return check.str[:-2]
+
+
+def preprocess_trektellen_data(data, split_by_station=False):
+    # Check doublecounts
+    suspicious_dc_records = check_doublecounts(data)
+
+    # Add flags to check column
+    data['check'] = check_records(data, suspicious_dc_records)
 
     if split_by_station:
         mask_station1 = data['telpost'] == '1. Sakhalvasho'
@@ -435,6 +477,191 @@ def preprocess_trektellen_data(data, split_by_station=False):
         return data
 
 
+def count_doublecounts(data_csv, date=None, all_seasons=False, chunksize=chunk_rows):
+    nr_doublecounts = 0
+
+    for data in pd.read_csv(data_csv, usecols=['date', 'timestamp', 'counttype'], chunksize=chunksize):
+        data = combine_date_and_timestamp(data)
+        season = select_season(data, date, all_seasons=all_seasons)
+        nr_doublecounts += (data.loc[season, 'counttype'] == 'D').sum()
+
+    return int(nr_doublecounts)
+
+
+def iter_raw_trektellen_data(data_csv, times=None, date=None, all_seasons=False, chunksize=chunk_rows):
+    """
+    Out-of-core version of preprocess_raw_trektellen_data. Reads the Trektellen data in chunks and yields time-ordered
+    chunks of complete days, indexed as if the data was processed at once. The data has to be ordered by date.
+
+    :param data_csv: path or buffer of Trektellen CSV data
+    :param times: dict with count start and end times of both stations
+    :param date: datetime object
+    :param all_seasons: Bool indicating whether to keep the records of all seasons instead of the current season
+    :param chunksize: number of rows read from the CSV at once
+    :return: generator of DataFrames
+    """
+    count_times = None
+    if times:
+        count_times = create_count_time_records(times)
+        count_times['datetime'] = pd.to_datetime(count_times['datetime'])
+
+    offset = 0
+    held_back = None
+
+    for data in pd.read_csv(data_csv, chunksize=chunksize):
+        data = pd.concat([held_back, data])
+
+        # Keep an empty chunk (e.g. from a CSV with only a header) to add the start and end times to later on
+        if data.empty:
+            held_back = data
+            continue
+
+        if not data['date'].is_monotonic_increasing:
+            raise ValueError('Out-of-core processing requires Trektellen data ordered by date.')
+
+        # Hold back records of the last date, as this date may continue in the next chunk
+        last_date = data['date'].iloc[-1]
+        held_back = data[data['date'] == last_date]
+        data = data[data['date'] != last_date]
+
+        if data.empty:
+            continue
+
+        # Add start and end times of the days within this chunk
+        chunk_count_times = None
+        if count_times is not None:
+            due = count_times['datetime'] < pd.Timestamp(last_date)
+            chunk_count_times = count_times[due]
+            count_times = count_times[~due]
+
+        data = format_raw_trektellen_data(data.copy(), chunk_count_times, date=date, all_seasons=all_seasons)
+        data.index = pd.RangeIndex(offset, offset + data.shape[0])
+        offset += data.shape[0]
+
+        if not data.empty:
+            yield data
+
+    if held_back is not None:
+        data = format_raw_trektellen_data(held_back.copy(), count_times, date=date, all_seasons=all_seasons)
+        data.index = pd.RangeIndex(offset, offset + data.shape[0])
+
+        if not data.empty:
+            yield data
+
+
+def check_chunk(chunk, preceding, following, nr_doublecounts, doublecount_nr, skip_doublecount):
+    """
+    Checks the records of a chunk, using the preceding and following records within the halo to evaluate windows
+    around records at the edges of the chunk. Doublecounts are paired in the same order as check_doublecounts does for
+    the full data, continuing at doublecount number doublecount_nr.
+
+    :return: checked chunk, number of the next doublecount and whether the next doublecount is paired already
+    """
+    data = pd.concat([preceding, chunk, following])
+
+    doublecount_records = data[data['counttype'] == 'D']
+    in_chunk = doublecount_records.index.isin(chunk.index)
+    nr_records = doublecount_records.shape[0]
+
+    suspicious_dc_records = []
+
+    for position in range(nr_records):
+        if not in_chunk[position]:
+            continue
+
+        if skip_doublecount:
+            skip_doublecount = False
+            doublecount_nr += 1
+            continue
+
+        if doublecount_nr == nr_doublecounts - 1:
+            break
+
+        row = doublecount_records.iloc[position]
+
+        if position + 1 < nr_records:
+            suspicious = doublecount_suspicious(row, doublecount_records.iloc[position + 1])
+        else:
+            # The next doublecount lies beyond the halo and thus outside of the doublecount window
+            suspicious = True
+
+        if not suspicious:
+            skip_doublecount = True
+        else:
+            suspicious_dc_records.extend([row.name])
+
+        doublecount_nr += 1
+
+    check = check_records(data, suspicious_dc_records)
+
+    chunk = chunk.copy()
+    chunk['check'] = check.loc[chunk.index]
+    return chunk, doublecount_nr, skip_doublecount
+
+
+def iter_checked_trektellen_data(chunks, nr_doublecounts):
+    """
+    Out-of-core version of preprocess_trektellen_data. Checks time-ordered chunks with a halo of records around them
+    as wide as the largest window used by the checks, so that the flags equal those of checking the data at once.
+
+    :param chunks: iterable of time-ordered DataFrames, e.g. from iter_raw_trektellen_data
+    :param nr_doublecounts: total number of doublecount records in all chunks
+    :return: generator of checked DataFrames
+    """
+    halo = pd.Timedelta(max(doublecount_minutes, window_minutes), 'm')
+
+    preceding = None
+    pending = []
+    doublecount_nr, skip_doublecount = 0, False
+
+    def check_next_chunk():
+        nonlocal preceding, doublecount_nr, skip_doublecount
+
+        chunk = pending.pop(0)
+        chunk_end = chunk['datetime'].max()
+
+        following = pd.concat(pending) if pending else chunk.iloc[:0]
+        following = following[following['datetime'] <= chunk_end + halo]
+
+        checked, doublecount_nr, skip_doublecount = check_chunk(chunk, preceding, following, nr_doublecounts,
+                                                                doublecount_nr, skip_doublecount)
+
+        preceding = pd.concat([preceding, chunk])
+        preceding = preceding[preceding['datetime'] >= chunk_end - halo]
+        return checked
+
+    for chunk in chunks:
+        pending.append(chunk)
+
+        # Only check a chunk once all records within the halo following it have been read
+        while len(pending) > 1 and pending[-1]['datetime'].max() > pending[0]['datetime'].max() + halo:
+            yield check_next_chunk()
+
+    while pending:
+        yield check_next_chunk()
+
+
+def preprocess_trektellen_data_chunked(data_csv, times=None, date=None, all_seasons=False, chunksize=chunk_rows):
+    """
+    Preprocesses and checks Trektellen data out-of-core, so that memory use does not depend on the size of the data.
+    The data is read twice, so a buffer is rewound in between.
+
+    :param data_csv: path or buffer of Trektellen CSV data ordered by date
+    :param times: dict with count start and end times of both stations
+    :param date: datetime object
+    :param all_seasons: Bool indicating whether to check the records of all seasons instead of the current season
+    :param chunksize: number of rows read from the CSV at once
+    :return: generator of checked DataFrames
+    """
+    nr_doublecounts = count_doublecounts(data_csv, date=date, all_seasons=all_seasons, chunksize=chunksize)
+
+    if hasattr(data_csv, 'seek'):
+        data_csv.seek(0)
+
+    chunks = iter_raw_trektellen_data(data_csv, times=times, date=date, all_seasons=all_seasons, chunksize=chunksize)
+    return iter_checked_trektellen_data(chunks, nr_doublecounts)
+
+
 if __name__ == "__main__":
     data = preprocess_raw_trektellen_data('data/2019.csv')
     data = preprocess_trektellen_data(data)